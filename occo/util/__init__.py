@@ -22,17 +22,21 @@ __all__ = ['coalesce', 'icoalesce', 'flatten', 'identity',
            'Cleaner', 'wet_method',
            'rel_to_file', 'cfg_file_path', 'config_base_dir',
            'set_config_base_dir',
-           'path_coalesce', 'file_locations',
-           'curried',
-           'logged', 'yamldump',
+           'path_coalesce', 'path_coalesce_with_stat', 'file_locations',
+           'curried', 'curried_fast',
+           'logged', 'enable_logged', 'yamldump',
            'f_raise',
            'basic_run_process', 'do_request', 'in_range',
            'HTTPStatusRange',
            'dict_get', 'dict_merge', 'dict_map','Infralist']
 
+import contextlib
+import functools
 import itertools
 import logging
+import os
 import sys
+import threading
 from .infralist import *
 
 def unique_vmname(node_def):
@@ -50,7 +54,11 @@ def icoalesce(iterable, default=None):
 
     If the value to be returned is an exception object, it is raised instead.
     """
-    result = next((i for i in iterable if i is not None), default)
+    for result in iterable:
+        if result is not None:
+            break
+    else:
+        result = default
     if isinstance(result, Exception):
         raise result
     return result
@@ -67,11 +75,24 @@ def path_coalesce(*paths):
 
     Can be used e.g. for defaulting a config file's path.
     """
-    import os
+    return path_coalesce_with_stat(*paths)[0]
+
+def path_coalesce_with_stat(*paths):
+    """
+    Same as :func:`path_coalesce`, but also returns the result of
+    :func:`os.stat` on the path found, so the caller need not stat it again.
+
+    :returns: ``(path, stat_result)`` of the first existing path, or
+        ``(None, None)``.
+    """
     for p in paths:
-        if p and os.path.exists(p):
-            return p
-    return None
+        if not p:
+            continue
+        try:
+            return p, os.stat(p)
+        except (OSError, ValueError):
+            continue
+    return None, None
 
 def file_locations(filename, *paths):
     """
@@ -93,14 +114,16 @@ def file_locations(filename, *paths):
         :data:`None`
             Treated the same way as ``''``.
     """
-    import os
+    join = os.path.join
+    # Ordered by frequency: most callers specify plain strings; callable()
+    # is the most expensive check.
     for p in paths:
-        if callable(p):
-            yield p(filename)
-        elif isinstance(p, str):
-            yield os.path.join(p, filename)
+        if isinstance(p, str):
+            yield join(p, filename)
         elif p is None:
             yield filename
+        elif callable(p):
+            yield p(filename)
         else:
             raise NotImplementedError('Unknonw file path definition')
 
@@ -133,7 +156,6 @@ def set_config_base_dir(path, use_dir=False, prefix=True):
     if path is None:
         config_base_dir = None
     else:
-        import os, sys
         d = os.path.dirname(path) if use_dir else path
         if os.path.isabs(path):
             if prefix:
@@ -145,6 +167,18 @@ def set_config_base_dir(path, use_dir=False, prefix=True):
 config_base_dir = None
 """The base directory for :func:`cfg_file_path`. Default values is the CWD."""
 
+_path_cache = dict()
+"""
+Results of :func:`cfg_file_path` that do not depend on the CWD. Keyed by
+``(filename, basedir, config_base_dir)``.
+"""
+
+_rel_path_cache = dict()
+"""
+Results of :func:`rel_to_file` that do not depend on the CWD. Keyed by
+``(path, basefile)``.
+"""
+
 def cfg_file_path(filename, basedir=None):
     """
     Returns the absolute path to ``filename`` based on ``sys.prefix`` and
@@ -171,16 +205,26 @@ def cfg_file_path(filename, basedir=None):
             # Opens (sys prefix)/etc/occo/test.yaml
             cfg = occo.util.config.DefaultYAMLConfig(f)
     """
-    import os, sys
+    key = filename, basedir, config_base_dir
+    try:
+        return _path_cache[key]
+    except KeyError:
+        pass
+
     pth = os.path
 
     if pth.isabs(filename):
         # Using `+` is necessary, as pth.join would simply omit sys.prefix
         # because filename is absolute.
-        return pth.abspath(sys.prefix + filename)
+        result = pth.abspath(sys.prefix + filename)
+    elif basedir is None and config_base_dir is None:
+        # Depends on the CWD, cannot be cached
+        return pth.join(os.getcwd(), filename)
     else:
-        basedir = coalesce(basedir, config_base_dir, os.getcwd())
-        return pth.join(basedir, filename)
+        result = pth.join(coalesce(basedir, config_base_dir), filename)
+
+    _path_cache[key] = result
+    return result
 
 def curried(func, **fixed_kwargs):
     """
@@ -218,11 +262,13 @@ def curried(func, **fixed_kwargs):
         possible_locations = list(
             util.file_locations('app.cfg',
                 '.',
-                util.curried(util.rel_to_file, basefile=__file__),
+                util.curried_fast(util.rel_to_file, basefile=__file__),
                 util.cfg_file_path))
+
+    Use :func:`curried_fast` when the proxy is created at runtime, on a hot
+    path.
     """
 
-    import functools
     @functools.wraps(func)
     def proxy(*args, **override_kwargs):
         kwargs = dict(fixed_kwargs)
@@ -231,6 +277,23 @@ def curried(func, **fixed_kwargs):
 
     return proxy
 
+def curried_fast(func, **fixed_kwargs):
+    """
+    Same as :func:`curried`, but the proxy only inherits the ``__name__`` and
+    ``__wrapped__`` attributes of the core function.
+
+    Copying the full metadata (:func:`functools.wraps`) is unnecessary for
+    short-lived proxies, e.g. those passed to :func:`file_locations`.
+    """
+    def proxy(*args, **override_kwargs):
+        kwargs = dict(fixed_kwargs)
+        kwargs.update(override_kwargs)
+        return func(*args, **kwargs)
+
+    proxy.__name__ = func.__name__
+    proxy.__wrapped__ = func
+    return proxy
+
 def rel_to_file(path, basefile=None, d_stack_frame=0, relative_cwd=False):
     """
     Returns the absolute version of ``relpath``, assuming it's relative to the
@@ -252,18 +315,28 @@ def rel_to_file(path, basefile=None, d_stack_frame=0, relative_cwd=False):
     etc.) relative to the module or executable that is calling it (e.g. test
     modules).
     """
-    from os.path import abspath, join, dirname, relpath
     if not basefile:
         # Default base path: path to the caller file
-        import inspect
-        fr = inspect.currentframe()
-        for i in range(d_stack_frame+1):
-            fr = fr.f_back
+        fr = sys._getframe(d_stack_frame+1)
         basefile = fr.f_globals['__file__']
-    pth = join(dirname(basefile), path)
-    return relpath(pth) \
-        if relative_cwd \
-        else abspath(pth)
+
+    # Only absolute results based on an absolute basefile are independent of
+    # the CWD
+    cacheable = not relative_cwd and os.path.isabs(basefile)
+    if cacheable:
+        key = path, basefile
+        try:
+            return _rel_path_cache[key]
+        except KeyError:
+            pass
+
+    pth = os.path.join(os.path.dirname(basefile), path)
+    if relative_cwd:
+        return os.path.relpath(pth)
+    result = os.path.abspath(pth)
+    if cacheable:
+        _rel_path_cache[key] = result
+    return result
 
 def identity(*args):
     """Returns all arguments as-is"""
@@ -272,7 +345,7 @@ def identity(*args):
     elif len(args) == 1:
         return args[0]
     else:
-        return tuple(args)
+        return args
 
 def nothing(*args, **kwargs):
     """Constant function: False"""
@@ -313,7 +386,15 @@ class Cleaner(object):
 
     :param object bar: The value with which censored data is to be
         substituted.
+
+    A ``Cleaner`` that censors nothing (the default) does not copy the data
+    structure at all: ``deep_copy()`` returns its argument as-is.
     """
+    #: Methods used by :meth:`deep_copy`; unless a subclass overrides any of
+    #: them, they are inlined for speed.
+    _EXTENSION_POINTS = ('hold_back_key', 'hold_back_value',
+                         'deep_copy_value', 'deep_copy_kvpair')
+
     def __init__(self,
                  hide_keys=[], hide_values=[],
                  match_hide_keys=nothing, match_hide_values=nothing,
@@ -324,20 +405,45 @@ class Cleaner(object):
         self.match_hide_keys = match_hide_keys
         self.match_hide_values = match_hide_values
 
+    def _censor_rules(self):
+        """The current censoring rules, prepared for fast lookup.
+
+        Derived from the public attributes on every call, so changes made to
+        them after construction (even in-place) take effect.
+
+        :return: ``(hidden_keys, hidden_values, match_key, match_value)``,
+            where the default matchers (:func:`nothing`) are replaced with
+            ``None``.
+        """
+        def lookup(items):
+            try:
+                return frozenset(items)
+            except TypeError:
+                # Unhashable items to be hidden: fall back to the list
+                return items
+        mhk, mhv = self.match_hide_keys, self.match_hide_values
+        return (lookup(self.hide_keys), lookup(self.hide_values),
+                None if mhk is nothing else mhk,
+                None if mhv is nothing else mhv)
+
     def hold_back_key(self, key):
         """Decides whether is a key to be censored.
 
         :param key: The key to be checked.
         :rtype: bool
         """
-        return (key in self.hide_keys) or (self.match_hide_keys(key))
+        mhk = self.match_hide_keys
+        return (key in self.hide_keys) \
+            or (mhk(key) if mhk is not nothing else False)
     def hold_back_value(self, value):
         """Decides whether is a value to be censored.
 
         :param value: The value to be checked.
         :rtype: bool
         """
-        return (value in self.hide_values) or (self.match_hide_values(value))
+        mhv = self.match_hide_values
+        return (value in self.hide_values) \
+            or (mhv(value) if mhv is not nothing else False)
 
     def deep_copy(self, obj):
         """Deep copies a data structure, censoring data if necessary.
@@ -345,14 +451,90 @@ class Cleaner(object):
         :param obj: The data structure to be copied.
         :type obj: Nested structure of dict and list objects. Any other type of
             object encountered is treated as scalar.
-        :return: A copy of ``obj``.
+        :return: A copy of ``obj``; or ``obj`` itself if this ``Cleaner``
+            censors nothing (has no rules, and overrides none of the
+            censoring methods).
         """
-        if type(obj) is dict:
-            return self.deep_copy_dict(obj)
-        elif type(obj) is list:
-            return self.deep_copy_list(obj)
+        bar = self.bar
+        cls = type(self)
+        if all(getattr(cls, name) is getattr(Cleaner, name)
+               for name in self._EXTENSION_POINTS):
+            # The rules are read once per call, not once per item
+            hidden_keys, hidden_values, mhk, mhv = self._censor_rules()
+            if not (hidden_keys or hidden_values) \
+                    and mhk is None and mhv is None:
+                # Censors nothing
+                return obj
+
+            # Not overridden: inline versions of the hold_back_* and
+            # deep_copy_* methods using the prepared rules
+            def hold_back_key(key):
+                try:
+                    if key in hidden_keys:
+                        return True
+                except TypeError:
+                    # Unhashable key: cannot be in a frozenset
+                    pass
+                return mhk(key) if mhk is not None else False
+            def hold_back_value(value):
+                try:
+                    if value in hidden_values:
+                        return True
+                except TypeError:
+                    # Unhashable value (e.g. a nested list or dict)
+                    pass
+                return mhv(value) if mhv is not None else False
+            def copy_value(value):
+                return bar if hold_back_value(value) else value
+            def copy_kvpair(key, value):
+                return (key, bar) \
+                    if hold_back_key(key) or hold_back_value(value) \
+                    else (key, value)
+            # Scalars need not be copied (and checked) before the pair
+            copy_scalar_pair = copy_kvpair
         else:
-            return self.deep_copy_value(obj)
+            # Overridden by a subclass: the methods must be called
+            hold_back_value = self.hold_back_value
+            copy_value = self.deep_copy_value
+            copy_kvpair = self.deep_copy_kvpair
+            def copy_scalar_pair(key, value):
+                return copy_kvpair(key, copy_value(value))
+
+        # The structure is walked iteratively (no recursion limit).
+        # Each container is copied once: the copies are memoized by the
+        # identity of the original, so shared sub-structures stay shared and
+        # cyclic structures are copied as cycles.
+        # Work items: (copy to be filled, original container).
+        memo = dict()
+        stack = []
+        def copy_container(item):
+            copy = memo.get(id(item))
+            if copy is None:
+                copy = memo[id(item)] = dict() if type(item) is dict else []
+                stack.append((copy, item))
+            return copy
+
+        if type(obj) is not dict and type(obj) is not list:
+            return copy_value(obj)
+        root = copy_container(obj)
+        while stack:
+            copy, item = stack.pop()
+            if type(item) is dict:
+                for k, v in item.items():
+                    if type(v) is dict or type(v) is list:
+                        k, cv = copy_kvpair(k, v)
+                        copy[k] = copy_container(v) if cv is v else cv
+                    else:
+                        k, cv = copy_scalar_pair(k, v)
+                        copy[k] = cv
+            else:
+                for v in item:
+                    if type(v) is dict or type(v) is list:
+                        copy.append(
+                            bar if hold_back_value(v) else copy_container(v))
+                    else:
+                        copy.append(copy_value(v))
+        return root
 
     def deep_copy_value(self, value):
         """ Satellite function to :func:`deep_copy` handling scalars. """
@@ -369,13 +551,10 @@ class Cleaner(object):
 
     def deep_copy_dict(self, d):
         """ Satellite function to :func:`deep_copy` handling ``dict`` s. """
-        return dict(self.deep_copy_kvpair(k,self.deep_copy(v))
-                    for k,v in list(d.items()))
+        return self.deep_copy(d)
     def deep_copy_list(self, l):
         """ Satellite function to :func:`deep_copy` handling ``list`` s. """
-        return [self.bar if self.hold_back_value(i)
-                else self.deep_copy(i)
-                for i in l]
+        return self.deep_copy(l)
 
 class wet_method(object):
     """
@@ -392,8 +571,6 @@ class wet_method(object):
         self.dry_run = dry_run
 
     def __call__(self, fun):
-        import functools
-
         @functools.wraps(fun)
         def wethod(fun_self_, *args, **kwargs):
             log = logging.getLogger('occo.util')
@@ -459,7 +636,8 @@ class logged(object):
     :param str postfix: Log record postfix for all generated log records.
 
     Logging can be globally enabled by setting ``logged.disabled`` to
-    :data:`False`.
+    :data:`False`; or enabled temporarily, in the current thread only, with
+    :func:`enable_logged`.
 
     .. warning:: This logging is not secure. Secrets provided for or generated
         by the decorated function are recorded in the logs.
@@ -473,21 +651,24 @@ class logged(object):
             logger_method, disabled, prefix, postfix
 
     def __call__(self, fun):
-        if logged.disabled or self.disabled:
+        globally_disabled = logged.disabled \
+            and not getattr(_logged_state, 'enabled', False)
+        if globally_disabled or self.disabled:
             return fun
 
-        import functools
+        import inspect
         log = self.logger_method
 
+        # Determine whether a method and remove self.
+        # inspect.ismethod would not work, as at the time this decorator
+        # runs, the function is not yet binded to the class.
+        fun_args = inspect.getfullargspec(fun).args
+        is_method = bool(fun_args) and fun_args[0] == 'self'
+
         @functools.wraps(fun)
         def wrapper(*args, **kwargs):
-            # Determine whether a method and remove self.
-            # inspect.ismethod would not work, as at the time this decorator
-            # runs, the function is not yet binded to the class.
-            import inspect
             all_args = args
-            fun_args = inspect.getargspec(fun).args
-            if fun_args and fun_args[0] == 'self':
+            if is_method:
                 args = args[1:] # Remove `self' from output
 
             funcdef = '[{0}; {1}; {2}]'.format(fun.__name__, args, kwargs)
@@ -499,6 +680,24 @@ class logged(object):
 
         return wrapper
 
+_logged_state = threading.local()
+
+@contextlib.contextmanager
+def enable_logged():
+    """
+    Context manager enabling :class:`logged` in the current thread.
+
+    Functions decorated inside the context are logged even if
+    ``logged.disabled`` is set; functions decorated elsewhere keep their
+    zero-overhead behaviour.
+    """
+    previous = getattr(_logged_state, 'enabled', False)
+    _logged_state.enabled = True
+    try:
+        yield
+    finally:
+        _logged_state.enabled = previous
+
 def yamldump(obj):
     """Shorthand for yaml.dump"""
     from ruamel import yaml
@@ -633,16 +832,20 @@ def dict_merge(dst, src):
     """
     import copy
 
-    def rec_merge(dst, src):
-        dst = copy.copy(dst)
-        for key, val in list(src.items()):
+    result = copy.copy(dst)
+    # Pairs of (shallow copy of a dst sub-dictionary, src sub-dictionary)
+    # still to be merged
+    stack = [(result, src)]
+    while stack:
+        dst, src = stack.pop()
+        for key, val in src.items():
             if (key in dst) and isinstance(val, dict) and isinstance(dst[key], dict):
-                dst[key] = rec_merge(dst[key], val)
+                sub = dst[key] = copy.copy(dst[key])
+                stack.append((sub, val))
             else:
                 dst[key] = copy.copy(val)
-        return dst
 
-    return rec_merge(dst, src)
+    return result
 
 def pair_map(pairs, value_trans=identity, key_trans=identity):
     return ((key_trans(k), value_trans(v)) for k, v in pairs)
@@ -149,6 +149,15 @@ class RPCProducer(factory.MultiBackend, CommChannel):
         """
         raise NotImplementedError
 
+    def push_messages(self, messages, **kwargs):
+        """Synchronous pushing of several messages.
+
+        Returns the list of results, in the order of ``messages``. This default
+        implementation calls :meth:`push_message` for each message in turn;
+        sub-classes should override it if they can pipeline the requests.
+        """
+        return [self.push_message(message, **kwargs) for message in messages]
+
 class EventDrivenConsumer(factory.MultiBackend, CommChannel):
     """Abstract interface of an event-driven message processor.
 
@@ -25,7 +25,7 @@ protocol.
 """
 
 __all__ = ['MQHandler', 'MQAsynchronProducer', 'MQRPCProducer',
-           'MQEventDrivenConsumer']
+           'MQEventDrivenConsumer', 'close_connection_pool']
 
 from . import comm
 import occo.util as util
@@ -35,6 +35,7 @@ import pika
 import uuid
 import logging
 import threading
+import sys
 from ruamel import yaml
 
 log = logging.getLogger('occo.util.comm.mq')
@@ -42,6 +43,73 @@ log = logging.getLogger('occo.util.comm.mq')
 #: These implementations are identified with the following protocol key:
 PROTOCOL_ID='amqp'
 
+#: Pooled producer connections, keyed by ``(host, port, vhost, user,
+#: thread)``. A :class:`pika.BlockingConnection` must not be shared between
+#: threads, so the identity of the owner thread is part of the key. Values are
+#: ``[connection, users]``, where ``users`` is the number of handlers inside
+#: a context using the connection.
+_CONN_POOL = dict()
+_CONN_POOL_LOCK = threading.Lock()
+
+def _close_quietly(connection):
+    """Closes a connection, ignoring errors (it may be dead already)."""
+    try:
+        if connection.is_open:
+            connection.close()
+    except Exception:
+        log.debug('Error closing pooled connection:', exc_info=True)
+
+def _evict_exited_threads():
+    """Closes and drops the unused pooled connections of threads that have
+    exited. (As the owner thread is gone, nothing else can be driving these
+    connections while they are closed.)
+
+    Must be called holding :data:`_CONN_POOL_LOCK`.
+    """
+    alive = set(t.ident for t in threading.enumerate())
+    for key in [k for k, (_, users) in _CONN_POOL.items()
+                if users == 0 and k[-1] not in alive]:
+        log.debug('Evicting pooled connection of exited thread: %r', key)
+        _close_quietly(_CONN_POOL.pop(key)[0])
+
+def _get_or_create_connection(parameters, key, reopen=False):
+    """Returns an open pooled connection for ``key`` (and the current
+    thread), creating it if needed, and registers a new user of it.
+
+    :param bool reopen: Replace the pooled connection with a new one, e.g.
+        because it has been found dead. The caller is not registered again.
+    """
+    key = key + (threading.current_thread().ident,)
+    with _CONN_POOL_LOCK:
+        _evict_exited_threads()
+        entry = _CONN_POOL.setdefault(key, [None, 0])
+        connection = entry[0]
+        if reopen and connection is not None:
+            _close_quietly(connection)
+        if reopen or connection is None or not connection.is_open:
+            log.debug('Opening pooled connection for %r', key)
+            connection = entry[0] = pika.BlockingConnection(parameters)
+        if not reopen:
+            entry[1] += 1
+        return connection
+
+def _release_connection(key, thread_ident):
+    """Unregisters a user of the pooled connection of ``key`` and the given
+    owner thread. The connection itself is kept open for reuse."""
+    key = key + (thread_ident,)
+    with _CONN_POOL_LOCK:
+        entry = _CONN_POOL.get(key)
+        if entry is not None and entry[1] > 0:
+            entry[1] -= 1
+
+def close_connection_pool():
+    """Closes all pooled producer connections."""
+    with _CONN_POOL_LOCK:
+        connections = list(_CONN_POOL.values())
+        _CONN_POOL.clear()
+    for connection, _ in connections:
+        _close_quietly(connection)
+
 class YAMLChannel(comm.CommChannel):
     """Implement channel serialization with YAML"""
     def serialize(self, obj):
@@ -68,6 +136,21 @@ class MQHandler(object):
     :keyword str routing_key: Default routing key, may be overridden by client
         methods. *Optional*, the default is ``None``.
     :keyword bool auto_delete: Auto delete queue. *Optional*, the default is ``False``.
+    :keyword bool declare_passive: Only check that queues exist instead of
+        declaring them (passive declaration). Use this when the queues are
+        known to be declared by someone else (e.g. the consumer). *Optional*,
+        the default is ``False``.
+    :keyword float socket_timeout: Socket timeout (seconds) of the connection,
+        so an unresponsive server is detected early. *Optional*, the pika
+        default is used if unspecified.
+    :keyword bool pool_connection: Take the connection from a pool shared by
+        all pooling handlers of the same server and thread, instead of opening
+        a new one; only the channel is private. Pooled connections stay open
+        until :func:`close_connection_pool` is called (or their thread exits
+        and no handler uses them any more). A pooled handler must only be
+        used from the thread that entered its context; using it from another
+        thread raises :exc:`RuntimeError`. *Optional*, the default is
+        ``False``.
 
     Subclasses may require additional configuration parameters.
     """
@@ -76,24 +159,66 @@ class MQHandler(object):
             log.debug('Config:\n%r', config)
             self.credentials = pika.PlainCredentials(
                 config['user'], config['password'])
+            extra_parameters = dict()
+            if 'socket_timeout' in config:
+                extra_parameters['socket_timeout'] = config['socket_timeout']
             self.connection_parameters = pika.ConnectionParameters(
                 config['host'], config.get('port', 5672),
-                config['vhost'], self.credentials)
+                config['vhost'], self.credentials, **extra_parameters)
+            self.connection_key = (config['host'], config.get('port', 5672),
+                                   config['vhost'], config['user'])
         except KeyError as e:
             raise exc.ConfigurationError(e)
         self.default_exchange = config.get('exchange', '')
         self.default_routing_key = config.get('routing_key', None)
         self.auto_delete = config.get('auto_delete', False)
+        self.declare_passive = config.get('declare_passive', False)
+        self.pool_connection = config.get('pool_connection', False)
 
     def __enter__(self):
         log.debug('Entering pika context, creating channel')
-        self.connection = pika.BlockingConnection(self.connection_parameters)
-        self.channel = self.connection.channel()
+        if self.pool_connection:
+            self.owner_thread = threading.current_thread().ident
+            self.connection = _get_or_create_connection(
+                self.connection_parameters, self.connection_key)
+            try:
+                try:
+                    self.channel = self.connection.channel()
+                except (pika.exceptions.AMQPConnectionError, OSError):
+                    log.warning('Pooled connection is dead; reconnecting',
+                                exc_info=True)
+                    self.connection = _get_or_create_connection(
+                        self.connection_parameters, self.connection_key,
+                        reopen=True)
+                    self.channel = self.connection.channel()
+            except BaseException:
+                _release_connection(self.connection_key, self.owner_thread)
+                raise
+        else:
+            self.connection = pika.BlockingConnection(
+                self.connection_parameters)
+            self.channel = self.connection.channel()
         return self
 
     def __exit__(self, type, value, tb):
         log.debug('Leaving pika context, closing channel')
-        self.channel.close()
+        try:
+            self.channel.close()
+        finally:
+            if self.pool_connection:
+                _release_connection(self.connection_key, self.owner_thread)
+
+    def check_owner_thread(self):
+        """Ensures that a pooled handler is used from the thread that entered
+        its context, as the pooled connection belongs to that thread.
+
+        :raises RuntimeError: if used from another thread.
+        """
+        if self.pool_connection \
+                and threading.current_thread().ident != self.owner_thread:
+            raise RuntimeError(
+                'A handler with a pooled connection must only be used '
+                'from the thread that entered its context')
 
     def effective_exchange(self, override=None):
         """Selects the exchange in effect.
@@ -124,13 +249,16 @@ class MQHandler(object):
     def declare_queue(self, queue_name, **kwargs):
         """Declares a non-exclusive queue with the given name.
 
+        If ``declare_passive`` is set, the queue is only checked to exist.
+
         :param str queue_name: The queue to be declared.
         :param `**kwargs`: Keyword arguments are passed through to the backend.
         """
-        log.debug('Declaring queue %r; auto_delete: %r',
-                  queue_name, self.auto_delete)
+        log.debug('Declaring queue %r; auto_delete: %r; passive: %r',
+                  queue_name, self.auto_delete, self.declare_passive)
         self.channel.queue_declare(
-            queue_name, auto_delete=self.auto_delete, **kwargs)
+            queue_name, passive=self.declare_passive,
+            auto_delete=self.auto_delete, **kwargs)
 
     def declare_response_queue(self, **kwargs):
         """Declares an auto-named, exclusive queue.
@@ -199,6 +327,7 @@ class MQAsynchronProducer(MQHandler, comm.AsynchronProducer, YAMLChannel):
         :param `**kwargs`: Keyword arguments are passed through to the backend.
         """
         log.debug('Sending asynchron message')
+        self.check_owner_thread()
         rkey = self.effective_routing_key(routing_key)
         self.declare_queue(rkey)
         self.publish_message(msg, routing_key=rkey, **kwargs)
@@ -210,7 +339,8 @@ class MQRPCProducer(MQHandler, comm.RPCProducer, YAMLChannel):
 
     This class is thread safe by mut.ex. access: at any time, only one RPC call
     can be pending. For multiple, simultaneous RPC calls, use multiple
-    instances of this class.
+    instances of this class. (With ``pool_connection``, an instance must only
+    be used from the thread that entered its context.)
 
     :param `**config`: Configuration for the :class:`MQHandler` backend.
 
@@ -218,8 +348,8 @@ class MQRPCProducer(MQHandler, comm.RPCProducer, YAMLChannel):
 
     .. todo:: It would be desirable to factor :meth:`__reset` out (it's ugly
         and bug-prone). Two ideas: co-routines (:keyword:`yield`) and closures
-        (moving the callback inside :meth:`push_message`). We should think this
-        through and fix it sometime.
+        (moving the callback inside :meth:`push_messages`). We should think
+        this through and fix it sometime.
     """
     def __init__(self, **config):
         super(MQRPCProducer,self).__init__(**config)
@@ -230,63 +360,95 @@ class MQRPCProducer(MQHandler, comm.RPCProducer, YAMLChannel):
     def __reset(self):
         """ Because the result arrives through a callback, these variables
         cannot be method-local variables: the callback function and the
-        push_message function must share this data. This implies that these
+        push_messages function must share this data. This implies that these
         variables must be reset between calls to avoid interference.
         """
-        self.response = None
-        self.correlation_id = None
+        # correlation_id -> response body (None while pending)
+        self.responses = dict()
+        self.pending = 0
 
     def __enter__(self):
         super(MQRPCProducer, self).__enter__()
-        self.callback_queue = self.declare_response_queue()
-        self.setup_consumer(
-            self.__on_response, no_ack=True, queue=self.callback_queue)
+        try:
+            self.callback_queue = self.declare_response_queue()
+            self.setup_consumer(
+                self.__on_response, no_ack=True, queue=self.callback_queue)
+        except BaseException:
+            # Release the channel (and the pooled connection)
+            MQHandler.__exit__(self, *sys.exc_info())
+            raise
 
     def __exit__(self, type, value, tb):
+        if self.pool_connection:
+            # The exclusive response queue would live as long as the pooled
+            # connection does
+            log.debug('Deleting response queue %r', self.callback_queue)
+            try:
+                self.channel.queue_delete(queue=self.callback_queue)
+            except Exception:
+                log.exception('Error deleting response queue:')
         super(MQRPCProducer, self).__exit__(type, value, tb)
 
     def __on_response(self, ch, method, props, body):
         """Callback function for RPC response.
 
-        It sets the value of ``self.response``
+        It stores the response in ``self.responses`` if it is expected.
         """
-        log.debug('RPC response callback; received message: %r, expecting %r',
-                  props.correlation_id, self.correlation_id)
-        if self.correlation_id == props.correlation_id:
-            self.response = body
+        log.debug('RPC response callback; received message: %r, '
+                  'pending: %d', props.correlation_id, self.pending)
+        if self.responses.get(props.correlation_id, body) is None:
+            self.responses[props.correlation_id] = body
+            self.pending -= 1
 
     def push_message(self, msg, routing_key=None, **kwargs):
         """Pushes a message and waits for response."""
+        log.debug('Sending RPC message')
+        return self.push_messages([msg], routing_key, **kwargs)[0]
+
+    def push_messages(self, msgs, routing_key=None, **kwargs):
+        """Pushes several messages and waits for all responses.
+
+        All messages are published before waiting for any response, so the
+        round trips overlap instead of being serialized.
 
+        :returns: The list of response data, in the order of ``msgs``.
+        :raises: The exception carried by the first failed response, if any.
+        """
         # try-finally is used instead of 'with self.lock' to avoid a level of
         # indent. But, when __reset will be factored out, this can be fixed.
-        log.debug('Sending RPC message')
+        log.debug('Sending %d RPC messages', len(msgs))
+        self.check_owner_thread()
         try:
             self.lock.acquire()
-            self.correlation_id = str(uuid.uuid4())
+            correlation_ids = [str(uuid.uuid4()) for _ in msgs]
+            self.responses.update((cid, None) for cid in correlation_ids)
+            self.pending = len(correlation_ids)
 
             # Ensure queue exists
             rkey = self.effective_routing_key(routing_key)
             self.declare_queue(rkey)
 
-            # Send request
-            self.publish_message(msg, routing_key=rkey,
-                                 properties=pika.BasicProperties(
-                                     reply_to = self.callback_queue,
-                                     correlation_id = self.correlation_id),
-                                 **kwargs)
+            # Send requests
+            for msg, cid in zip(msgs, correlation_ids):
+                self.publish_message(msg, routing_key=rkey,
+                                     properties=pika.BasicProperties(
+                                         reply_to = self.callback_queue,
+                                         correlation_id = cid),
+                                     **kwargs)
 
-            # Wait for response
-            log.debug('RPC push message: waiting for response')
-            while self.response is None:
+            # Wait for all responses
+            log.debug('RPC push messages: waiting for responses')
+            while self.pending:
                 self.connection.process_data_events()
-            log.debug('RPC push message: received response: %r', self.response)
+            log.debug('RPC push messages: all responses received')
 
-            # Process response
-            response = self.deserialize(self.response)
-            response.check()
+            # Process responses
+            responses = [self.deserialize(self.responses[cid])
+                         for cid in correlation_ids]
+            for response in responses:
+                response.check()
 
-            return response.data
+            return [response.data for response in responses]
         finally:
             # Must reset variables used to communicate between this function
             # and the callback. See class docstring.
@@ -301,6 +463,10 @@ class MQEventDrivenConsumer(MQHandler, comm.EventDrivenConsumer, YAMLChannel):
 
     Supports being the target of a :class:`threading.Thread`.
 
+    The processor is called directly from the pika callback, in the thread
+    running :meth:`start_consuming`; there is no intermediate dispatch
+    queue. Hence, the processor should return quickly.
+
     :param callable processor: The core function to be called when a message
         arrives.  For details, see the documentation of
         :class:`~occo.util.communication.comm.EventDrivenConsumer`.
@@ -316,6 +482,10 @@ class MQEventDrivenConsumer(MQHandler, comm.EventDrivenConsumer, YAMLChannel):
     :param `**config`: Configuration
         for the :class:`MQHandler` backend.
 
+    :keyword int prefetch_count: The number of unacknowledged messages the
+        broker may push to this consumer in advance. *Optional*, the default
+        is ``1`` (fair dispatch among multiple consumers).
+
     .. warning:: Use context management with this class (:keyword:`with`).
 
     .. automethod:: __call__
@@ -331,11 +501,15 @@ class MQEventDrivenConsumer(MQHandler, comm.EventDrivenConsumer, YAMLChannel):
             self.queue = config['queue']
         except KeyError:
             raise exc.ConfigurationError('queue', 'Queue name is mandatory')
+        self.prefetch_count = config.get('prefetch_count', 1)
+        # Consumers are usually driven by a thread of their own, so they cannot
+        # share a connection with the producers.
+        self.pool_connection = False
 
     def __enter__(self):
         super(MQEventDrivenConsumer, self).__enter__()
         self.declare_queue(self.queue)
-        self.channel.basic_qos(prefetch_count=1)
+        self.channel.basic_qos(prefetch_count=self.prefetch_count)
         self.setup_consumer(self.__callback, queue=self.queue)
 
     def __reply_if_rpc(self, response, props):
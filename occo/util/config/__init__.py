@@ -41,6 +41,13 @@ import occo.exceptions as exc
 import os, sys
 import logging
 
+try:
+    # The C parser is much faster; the constructors (including the custom
+    # tags registered below) are shared with the pure-Python loader.
+    from ruamel.yaml.cyaml import CLoader as _Loader
+except ImportError:
+    from ruamel.yaml.loader import Loader as _Loader
+
 DEFAULT_LOGGING_CFG = dict(
     version=1
 )
@@ -97,8 +104,7 @@ class YAMLLoad_Parsed(YAMLLoad):
     the filename of the input file.
     """
     def _open_loader(self):
-        from ruamel.yaml.loader import Loader
-        self.loader = Loader(self.stream)
+        self.loader = _Loader(self.stream)
         self.loader._filename = os.path.abspath(self.stream_name)
 
     def get_single_node(self):
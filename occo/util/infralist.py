@@ -14,49 +14,135 @@
 
 """
 Primitives for managing list of infra identifiers 
+
+The list is stored as JSON. As JSON is a subset of YAML, the store file
+remains readable as YAML; files written in YAML by earlier versions are still
+accepted, and are converted upon the next store.
 """
 
+__all__ = ['Infralist']
+
 import os
-from ruamel import yaml
+import json
+import tempfile
+import yaml
+try:
+    from yaml import CSafeLoader as Loader
+except ImportError:
+    from yaml import SafeLoader as Loader
 
 #log = logging.getLogger('occo.util.infralist')
 
+_DEFAULT_STOREFILE = os.path.join(
+    os.path.expanduser('~'), '.occopus', 'infralist.yaml')
+
+# Shared by all store() calls
+_encoder = json.JSONEncoder()
+
 class Infralist(object):
+    """
+    Persistent list of infra identifiers.
+
+    Identifiers are unique; internally they are kept in an insertion-ordered
+    :class:`dict` so they can be added and removed in constant time.
+
+    Can be used as a context manager to batch several :meth:`add` and
+    :meth:`remove` calls: the list is read upon entering the context, and is
+    written only once, upon exiting.
+    """
     def __init__(self,storefile=None):
-        if not storefile:
-            storefile = os.path.join(os.path.expanduser('~'),'.occopus/infralist.yaml')
-        self.storefile = storefile
+        self.storefile = storefile or _DEFAULT_STOREFILE
+        self._dirname = os.path.dirname(self.storefile)
+        # Parsed content of the store, valid while the (mtime, size) of the
+        # file equals _cache_stat
+        self._cache = None
+        self._cache_stat = None
+        # The identifiers being modified inside a batch (context)
+        self._batch = None
+
+    def __enter__(self):
+        self._batch = self._load()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        batch, self._batch = self._batch, None
+        # A failed batch is discarded, not stored half-done
+        if exc_type is None:
+            self.store(batch)
+
+    def _stat_key(self):
+        st = os.stat(self.storefile)
+        return st.st_mtime_ns, st.st_size
 
     def store(self,infralist):
-        dirname = os.path.dirname(self.storefile)
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
-        with open(self.storefile, 'w') as yaml_file:
-            yaml_file.write( 
-                yaml.dump( infralist, default_flow_style=False))
+        if self._dirname:
+            os.makedirs(self._dirname, exist_ok=True)
+        # Write a temporary file and rename it, so the store is never left
+        # truncated or half-written. The temporary file is unique, so
+        # concurrent writers do not clobber each other's.
+        fd, tmpfile = tempfile.mkstemp(
+            dir=self._dirname,
+            prefix=os.path.basename(self.storefile) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as store_file:
+                store_file.write(_encoder.encode(list(infralist)))
+                store_file.flush()
+                os.fsync(store_file.fileno())
+            os.replace(tmpfile, self.storefile)
+        except BaseException:
+            os.unlink(tmpfile)
+            raise
+        self._cache = dict.fromkeys(infralist)
+        self._cache_stat = self._stat_key()
 
-    def retrieve(self):
-        if os.path.isfile(self.storefile):
-            with open(self.storefile, 'r') as stream:
+    def _load(self):
+        """Returns the stored identifiers as the keys of a new dict."""
+        try:
+            stat_key = self._stat_key()
+        except FileNotFoundError:
+            return dict()
+        if stat_key == self._cache_stat:
+            return dict(self._cache)
+        try:
+            stream = open(self.storefile, 'r')
+        except FileNotFoundError:
+            return dict()
+        with stream:
+            try:
+                infralist = list(json.load(stream))
+            except ValueError:
+                # Legacy YAML store
+                stream.seek(0)
                 try:
-                    infralist = list(yaml.load(stream,Loader=yaml.Loader))
+                    infralist = list(yaml.load(stream,Loader=Loader))
                 except yaml.YAMLError as exc:
                     print(exc)
-        else:
-            infralist = list()
-        return infralist
+        self._cache = dict.fromkeys(infralist)
+        self._cache_stat = stat_key
+        return dict(self._cache)
+
+    def retrieve(self):
+        return list(self._load())
 
     def add(self,infraid):
-        infralist = self.retrieve()
-        infralist.append(infraid)
-        self.store(infralist)
+        if self._batch is not None:
+            self._batch[infraid] = None
+            return
+        infras = self._load()
+        infras[infraid] = None
+        self.store(infras)
 
     def remove(self,infraid):
-        infralist = self.retrieve()
-        infralist.remove(infraid)
-        self.store(infralist)
+        if self._batch is not None:
+            self._batch.pop(infraid, None)
+            return
+        infras = self._load()
+        infras.pop(infraid, None)
+        self.store(infras)
 
     def get(self):
+        if self._batch is not None:
+            return list(self._batch)
         return self.retrieve()
 
     def path(self):
@@ -16,7 +16,8 @@
 Primitives for parallel processing.
 """
 
-__all__ = ['exiting', 'GracefulProcess', 'init']
+__all__ = ['exiting', 'exiting_is_set', 'signal_exit',
+           'GracefulProcess', 'init']
 
 import threading
 import logging
@@ -24,12 +25,42 @@ import signal, os
 
 log = logging.getLogger('occo.util.parproc')
 
-exiting = threading.Event()
+_exiting = [False]
+
+class _ExitingEvent(threading.Event):
+    """
+    :class:`~threading.Event` that also maintains the plain flag read by
+    :func:`exiting_is_set`.
+    """
+    def set(self):
+        _exiting[0] = True
+        super(_ExitingEvent, self).set()
+
+    def clear(self):
+        _exiting[0] = False
+        super(_ExitingEvent, self).clear()
+
+exiting = _ExitingEvent()
 """
 Globally available :class:`~threading.Event` object that can be used to signal
 threads that the application is exiting.
+
+Threads that need to block until exiting should ``wait()`` on this object;
+threads that only poll should use :func:`exiting_is_set`.
 """
 
+def exiting_is_set():
+    """
+    Returns :data:`True` iff the application is exiting.
+
+    Cheaper than ``exiting.is_set()``: it is a single read of a plain flag.
+    """
+    return _exiting[0]
+
+def signal_exit():
+    """Signal all threads that the application is exiting."""
+    exiting.set()
+
 def init():
     """
     Initialize the synchronization framework.
@@ -42,6 +73,13 @@ import multiprocessing
 
 class StillRunning(Exception): pass
 
+def _as_signal(sig):
+    """Normalises a signal given by name (``'SIGTERM'``) or number to a
+    :class:`signal.Signals` member."""
+    if isinstance(sig, str):
+        return getattr(signal, sig)
+    return signal.Signals(sig)
+
 class GracefulProcess(multiprocessing.Process):
     """
     Extends :class:`multiprocessing.Process` with graceful exiting.
@@ -61,28 +99,31 @@ class GracefulProcess(multiprocessing.Process):
 
     """
 
-    SIGLIST = ['SIGINT', 'SIGTERM', 'SIGKILL']
+    #: Signals to be tried, in order. Items may be :class:`signal.Signals`
+    #: members, signal numbers, or signal names (e.g. ``'SIGTERM'``).
+    SIGLIST = [signal.SIGINT, signal.SIGTERM, signal.SIGKILL]
 
     def graceful_terminate(self, timeout):
-        
-
         log.info('Killing process %d', self.pid)
 
-        for sig, next_sig in zip(self.SIGLIST, self.SIGLIST[1:]):
+        # SIGLIST may be overridden by subclasses (or instances)
+        siglist = [_as_signal(sig) for sig in self.SIGLIST]
+        for sig, next_sig in zip(siglist, siglist[1:]):
             try:
-                log.debug('Trying %s', sig)
+                log.debug('Trying %s', sig.name)
                 self._trykill(sig, timeout)
             except StillRunning:
                 log.warning('%s: Process %d has not exited in %d seconds. '
-                            'Trying %s...', sig, self.pid, timeout, next_sig)
+                            'Trying %s...',
+                            sig.name, self.pid, timeout, next_sig.name)
                 continue
             else:
                 log.info('Process %d has been sucessfully killed with %s',
-                         self.pid, sig)
+                         self.pid, sig.name)
                 break
 
-    def _trykill(self, signame, timeout):
-        sig = getattr(signal, signame)
+    def _trykill(self, sig, timeout):
+        # sig is a signal.Signals member, normalised by graceful_terminate
         os.kill(self.pid, sig)
 
         try:
@@ -27,7 +27,7 @@ class TestFactory(factory.MultiBackend):
 class TestFactoryImp(TestFactory):
     pass
 
-class CoalesceTest(unittest.TestCase):
+class FactoryTest(unittest.TestCase):
     def test_has(self):
         self.assertTrue(TestFactory.has_backend('test'))
         self.assertFalse(TestFactory.has_backend('nonexistent'))
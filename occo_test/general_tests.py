@@ -13,7 +13,14 @@
 ### limitations under the License.
 
 import unittest
+from unittest import mock
+import itertools
+import os, sys
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 import uuid, requests.exceptions as exc
 import occo.util as util
 import occo.util.config as config
@@ -21,13 +28,47 @@ import logging
 import logging.config
 
 with open(util.rel_to_file('logging.yaml')) as f:
-    logging.config.dictConfig(yaml.load(f))
+    logging.config.dictConfig(yaml.load(f, Loader=SafeLoader))
 log = logging.getLogger('occo.test')
 
 class DummyException(Exception):
     pass
 
 class GeneralTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Test documents are parsed only once
+        cls._cleaner_in = yaml.load("""
+                        pass: alma
+                        password: xyz
+                        public: yaay
+                        stuff:
+                            -
+                                secret: zyx
+                            -
+                                - zyx
+                                - alma
+                        """, Loader=SafeLoader)
+        cls._cleaner_out = yaml.load("""
+                         pass: XXX
+                         password: XXX
+                         public: yaay
+                         stuff:
+                            -
+                                secret: XXX
+                            -
+                                - XXX
+                                - alma
+                         """, Loader=SafeLoader)
+        cls._dict_get_doc = yaml.load("""
+                         a:
+                            b:
+                                c:
+                                    d
+                         b:
+                            x
+                         """, Loader=SafeLoader)
+
     def test_i_empty(self):
         self.assertIsNone(util.icoalesce([]))
     def test_i_default(self):
@@ -51,51 +92,50 @@ class GeneralTest(unittest.TestCase):
     def test_flatten(self):
         l1, l2, l3 = [0, 1, 2, 3], [], [4, 5, 6]
         self.assertEqual(list(util.flatten([l1, l2, l3])), list(range(7)))
+    def test_flatten_lazy(self):
+        # Must not consume the (infinite) input eagerly
+        infinite = util.flatten(itertools.repeat([1, 2]))
+        self.assertEqual(list(itertools.islice(infinite, 5)), [1, 2, 1, 2, 1])
     def test_rel_to_file(self):
         # TODO 1) this is not a test
         #      2) need to test d_stack_frame too
         print(util.rel_to_file('test.yaml'))
-    def test_cfg_path1(self):
-        import sys, os
-        # Reset config path
-        util.set_config_base_dir(None)
-        self.assertEqual(util.cfg_file_path('alma'),
-                         os.path.join(os.getcwd(), 'alma'))
-    def test_cfg_path2(self):
-        import sys, os
-        # Reset config path
-        util.set_config_base_dir(None)
-        self.assertEqual(util.cfg_file_path('alma', '/etc/occo'),
-                         os.path.join('/etc/occo', 'alma'))
-    def test_cfg_path3(self):
-        import sys, os
-        util.set_config_base_dir('/etc/occo', prefix=False)
-        self.assertEqual(util.cfg_file_path('alma'),
-                         '/etc/occo/alma')
-    def test_cfg_path4(self):
-        import sys, os
-        util.set_config_base_dir('/etc/occo')
-        self.assertEqual(util.cfg_file_path('alma', '/etc/occo2'),
-                         '/etc/occo2/alma')
-    def test_cfg_path5(self):
-        import sys, os
-        # Reset config path
-        util.set_config_base_dir(None)
-        self.assertEqual(util.cfg_file_path('/etc/occo/alma'),
-                         sys.prefix + '/etc/occo/alma')
-    def test_cfg_path6(self):
-        import sys, os
-        # Reset config path
-        util.set_config_base_dir(None)
-        self.assertEqual(util.cfg_file_path('/etc/occo/alma', 'anyth:ng'),
-                         sys.prefix + '/etc/occo/alma')
-    def test_cfg_path7(self):
-        import sys, os
-        # Reset config path
-        util.set_config_base_dir(None)
-        util.set_config_base_dir('etc/occo', prefix=False)
-        self.assertEqual(util.cfg_file_path('alma'),
-                         os.path.join(os.getcwd(), 'etc/occo/alma'))
+    def test_cfg_path(self):
+        CWD = os.getcwd()
+        # config base dir, prefix, filename, basedir, expected
+        CASES = [
+            (None, True, 'alma', None, os.path.join(CWD, 'alma')),
+            (None, True, 'alma', '/etc/occo', os.path.join('/etc/occo', 'alma')),
+            ('/etc/occo', False, 'alma', None, '/etc/occo/alma'),
+            ('/etc/occo', True, 'alma', '/etc/occo2', '/etc/occo2/alma'),
+            (None, True, '/etc/occo/alma', None, sys.prefix + '/etc/occo/alma'),
+            (None, True, '/etc/occo/alma', 'anyth:ng',
+                sys.prefix + '/etc/occo/alma'),
+            ('etc/occo', False, 'alma', None,
+                os.path.join(CWD, 'etc/occo/alma')),
+        ]
+        try:
+            for base, prefix, filename, basedir, expected in CASES:
+                with self.subTest(base=base, filename=filename,
+                                  basedir=basedir):
+                    # Reset config path
+                    util.set_config_base_dir(None)
+                    if base is not None:
+                        util.set_config_base_dir(base, prefix=prefix)
+                    self.assertEqual(util.cfg_file_path(filename, basedir),
+                                     expected)
+        finally:
+            util.set_config_base_dir(None)
+    def test_cfg_path_cache(self):
+        # Cached results must follow config_base_dir, however it is changed
+        try:
+            for base in ['/etc/occo', '/etc/occo2', '/etc/occo']:
+                with self.subTest(base=base):
+                    util.config_base_dir = base
+                    self.assertEqual(util.cfg_file_path('alma'),
+                                     os.path.join(base, 'alma'))
+        finally:
+            util.set_config_base_dir(None)
 
     def test_path_coalesce(self):
         pc = util.path_coalesce
@@ -104,6 +144,14 @@ class GeneralTest(unittest.TestCase):
         self.assertIsNone(pc('nonexistentfile'))
         self.assertEqual(pc(None, __file__), __file__)
 
+    def test_path_coalesce_with_stat(self):
+        pcs = util.path_coalesce_with_stat
+        self.assertEqual(pcs(), (None, None))
+        self.assertEqual(pcs(None, 'nonexistentfile'), (None, None))
+        path, st = pcs('nonexistentfile', __file__)
+        self.assertEqual(path, __file__)
+        self.assertEqual(st.st_size, os.stat(__file__).st_size)
+
     def test_file_locations(self):
         fl = util.file_locations
         self.assertEqual(
@@ -117,6 +165,15 @@ class GeneralTest(unittest.TestCase):
             return x+y
         self.assertEqual(cu(add, y=2)(2), 4)
 
+    def test_curried_fast(self):
+        cu = util.curried_fast
+        def add(x, y):
+            return x+y
+        add2 = cu(add, y=2)
+        self.assertEqual(add2(2), 4)
+        self.assertEqual(add2.__name__, 'add')
+        self.assertIs(add2.__wrapped__, add)
+
     def test_identity(self):
         i = util.identity
         self.assertIsNone(i())
@@ -130,30 +187,42 @@ class GeneralTest(unittest.TestCase):
 
     def test_cleaner(self):
         c = util.Cleaner(hide_keys=['pass'], hide_values=['xyz', 'zyx'])
-        _in = yaml.load("""
-                        pass: alma
-                        password: xyz
-                        public: yaay
-                        stuff:
-                            -
-                                secret: zyx
-                            -
-                                - zyx
-                                - alma
-                        """)
-        _out = yaml.load("""
-                         pass: XXX
-                         password: XXX
-                         public: yaay
-                         stuff:
-                            -
-                                secret: XXX
-                            -
-                                - XXX
-                                - alma
-                         """)
-        obfuscated = c.deep_copy(_in)
-        self.assertEqual(obfuscated, _out)
+        obfuscated = c.deep_copy(self._cleaner_in)
+        self.assertEqual(obfuscated, self._cleaner_out)
+
+    def test_cleaner_changed_rules(self):
+        c = util.Cleaner(hide_keys=['pass'])
+        c.hide_keys.append('token')
+        c.match_hide_values = lambda v: v == 'secret'
+        self.assertEqual(c.deep_copy(dict(token=1, x=['secret', 2])),
+                         dict(token='XXX', x=['XXX', 2]))
+
+    def test_cleaner_subclass(self):
+        class PrefixCleaner(util.Cleaner):
+            def hold_back_key(self, key):
+                return key.startswith('secret')
+        c = PrefixCleaner(hide_keys=['pass'])
+        self.assertEqual(c.deep_copy(dict(secret_x=1, l=[dict(secret_y=2)])),
+                         dict(secret_x='XXX', l=[dict(secret_y='XXX')]))
+        # No rules, but the override still censors
+        self.assertEqual(PrefixCleaner().deep_copy(dict(secret_x=1)),
+                         dict(secret_x='XXX'))
+
+    def test_cleaner_cycle(self):
+        data = dict(a=1, shared=[2])
+        data['self'], data['again'] = data, data['shared']
+        copy = util.Cleaner(hide_keys=['a']).deep_copy(data)
+        self.assertIsNot(copy, data)
+        self.assertIs(copy['self'], copy)
+        self.assertIs(copy['again'], copy['shared'])
+        self.assertEqual(copy['a'], 'XXX')
+
+    def test_cleaner_noop(self):
+        data = dict(a=[1, dict(b=2)])
+        self.assertIs(util.Cleaner().deep_copy(data), data)
+        c = util.Cleaner()
+        c.match_hide_keys = lambda k: k == 'b'
+        self.assertEqual(c.deep_copy(data), dict(a=[1, dict(b='XXX')]))
 
     def test_wethod(self):
         class WC(object):
@@ -185,11 +254,10 @@ class GeneralTest(unittest.TestCase):
         def setx(fmt, *args):
             items.append(fmt%tuple(args))
 
-        util.logged.disabled = False
-
-        @util.logged(setx)
-        def fun(x, y):
-            return x+y
+        with util.enable_logged():
+            @util.logged(setx)
+            def fun(x, y):
+                return x+y
 
         fun(1, 2)
         self.assertEqual(items,
@@ -203,12 +271,11 @@ class GeneralTest(unittest.TestCase):
         def setx(fmt, *args):
             items.append(fmt%tuple(args))
 
-        util.logged.disabled = False
-
-        class A(object):
-            @util.logged(setx)
-            def fun(self, x, y):
-                return x+y
+        with util.enable_logged():
+            class A(object):
+                @util.logged(setx)
+                def fun(self, x, y):
+                    return x+y
 
         A().fun(1, 2)
         self.assertEqual(items,
@@ -217,6 +284,13 @@ class GeneralTest(unittest.TestCase):
                              'Function result: [fun; (1, 2); {}] -> [3]'
                          ])
 
+    def test_logged_disabled(self):
+        def fun(x, y):
+            return x+y
+        with util.enable_logged():
+            pass
+        self.assertIs(util.logged(print)(fun), fun)
+
     def test_yaml_dump(self):
         # Only a wrapper for yaml.dump, so the test is only for coverage
         util.yamldump(dict(a=1, b=2))
@@ -226,11 +300,22 @@ class GeneralTest(unittest.TestCase):
            util.f_raise(Exception())
 
     def test_run_process(self):
-        data='stuffstuff'
+        data=b'stuffstuff'
         rc, stdout, stderr = util.basic_run_process('cat', data)
         self.assertEqual(rc, 0)
         self.assertEqual(stdout, data)
 
+    def test_run_process_argv(self):
+        # Popen is patched: only the handling of the command is tested
+        with mock.patch('subprocess.Popen') as popen:
+            sp = popen.return_value
+            sp.communicate.return_value = (b'out', b'err')
+            sp.returncode = 3
+            result = util.basic_run_process('ls  -l /etc', b'data')
+        self.assertEqual(popen.call_args[0][0], ['ls', '-l', '/etc'])
+        sp.communicate.assert_called_once_with(b'data')
+        self.assertEqual(result, (3, b'out', b'err'))
+
     @unittest.skip("Skipping slow test of util.do_request")
     def test_do_request(self):
         dr = util.do_request
@@ -243,14 +328,7 @@ class GeneralTest(unittest.TestCase):
     def test_dict_get(self):
         dg = util.dict_get
         dgl = util.dict_get_lst
-        data = yaml.load("""
-                         a:
-                            b:
-                                c:
-                                    d
-                         b:
-                            x
-                         """)
+        data = self._dict_get_doc
         self.assertEqual(dg(data, 'a.b.c'), 'd')
         with self.assertRaises(ValueError):
             dgl(data, [])
@@ -287,6 +365,16 @@ class GeneralTest(unittest.TestCase):
         s, d = util.find_effective_setting(testsettings(), True)
         self.assertEqual((s, d), ('b', 1))
 
+    def test_find_effective_setting_lazy(self):
+        pulled = []
+        def settings():
+            for src, value in [('a', None), ('b', 1), ('c', 2)]:
+                pulled.append(src)
+                yield src, value
+        util.find_effective_setting(settings())
+        # Sources after the effective one must not be evaluated
+        self.assertEqual(pulled, ['a', 'b'])
+
     def test_ip_exceptions(self):
         import occo.exceptions.orchestration as exc
         iid = 1
@@ -0,0 +1,117 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+import unittest
+from unittest import mock
+import os
+import json
+import shutil
+import stat
+import tempfile
+from occo.util.infralist import Infralist
+
+class DummyException(Exception):
+    pass
+
+class InfralistTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.storefile = os.path.join(self.tmpdir, 'sub', 'infralist.yaml')
+        self.il = Infralist(self.storefile)
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def read_store(self):
+        with open(self.storefile) as f:
+            return f.read()
+    def test_empty(self):
+        self.assertEqual(self.il.get(), [])
+        self.assertFalse(os.path.exists(self.storefile))
+    def test_path(self):
+        self.assertEqual(self.il.path(), self.storefile)
+    def test_json_format(self):
+        self.il.add('infra1')
+        self.il.add('infra2')
+        self.assertEqual(json.loads(self.read_store()), ['infra1', 'infra2'])
+        self.assertEqual(Infralist(self.storefile).get(),
+                         ['infra1', 'infra2'])
+    def test_legacy_yaml(self):
+        os.makedirs(os.path.dirname(self.storefile))
+        with open(self.storefile, 'w') as f:
+            f.write('- infra1\n- infra2\n')
+        self.assertEqual(self.il.get(), ['infra1', 'infra2'])
+        self.il.add('infra3')
+        self.assertEqual(json.loads(self.read_store()),
+                         ['infra1', 'infra2', 'infra3'])
+    def test_cache(self):
+        self.il.add('infra1')
+        # Unchanged store: served from the cache, the file is not read
+        with mock.patch('occo.util.infralist.open', create=True,
+                        side_effect=AssertionError('store re-read')):
+            self.assertEqual(self.il.get(), ['infra1'])
+        # Store changed by someone else: re-read
+        with open(self.storefile, 'w') as f:
+            f.write('["infra1", "infra2"]')
+        self.assertEqual(self.il.get(), ['infra1', 'infra2'])
+    def test_cache_copy(self):
+        self.il.add('infra1')
+        self.il.get().append('infra2')
+        self.assertEqual(self.il.get(), ['infra1'])
+    def test_batch(self):
+        self.il.add('infra1')
+        with mock.patch.object(self.il, 'store',
+                               wraps=self.il.store) as store:
+            with self.il as il:
+                il.add('infra2')
+                il.add('infra3')
+                il.remove('infra1')
+                self.assertEqual(il.get(), ['infra2', 'infra3'])
+                # Nothing is written before exiting the batch
+                self.assertEqual(json.loads(self.read_store()), ['infra1'])
+            self.assertEqual(store.call_count, 1)
+        self.assertEqual(json.loads(self.read_store()), ['infra2', 'infra3'])
+    def test_batch_exception(self):
+        self.il.add('infra1')
+        with self.assertRaises(DummyException):
+            with self.il as il:
+                il.add('infra2')
+                il.remove('infra1')
+                raise DummyException()
+        self.assertEqual(self.il.get(), ['infra1'])
+        self.assertEqual(json.loads(self.read_store()), ['infra1'])
+    def test_store_mode(self):
+        self.il.add('infra1')
+        mode = stat.S_IMODE(os.stat(self.storefile).st_mode)
+        self.assertEqual(mode, 0o600)
+    def test_store_atomic(self):
+        self.il.add('infra1')
+        # A failing store leaves the previous content and no temporary file
+        with self.assertRaises(TypeError):
+            self.il.store(['infra1', object()])
+        self.assertEqual(json.loads(self.read_store()), ['infra1'])
+        self.assertEqual(os.listdir(os.path.dirname(self.storefile)),
+                         ['infralist.yaml'])
+        self.assertEqual(self.il.get(), ['infra1'])
+    def test_dedup(self):
+        self.il.add('infra1')
+        self.il.add('infra2')
+        self.il.add('infra1')
+        self.assertEqual(self.il.get(), ['infra1', 'infra2'])
+    def test_remove(self):
+        self.il.add('infra1')
+        self.il.add('infra2')
+        self.il.remove('infra1')
+        self.assertEqual(self.il.get(), ['infra2'])
+        # Removing an unknown identifier is a no-op
+        self.il.remove('infra3')
+        self.assertEqual(self.il.get(), ['infra2'])
@@ -24,239 +24,258 @@ import logging
 import logging.config
 import uuid
 import time
+import functools
+import concurrent.futures
+import faulthandler
+import os
 
-cfg = config.DefaultYAMLConfig(util.rel_to_file('comm_test_cfg.yaml'))
+@functools.lru_cache(maxsize=None)
+def _load_cfg(path):
+    return config.DefaultYAMLConfig(path)
+
+cfg = _load_cfg(util.rel_to_file('comm_test_cfg.yaml'))
+
+#: Upper bound (seconds) for waiting on consumer threads and messages
+TIMEOUT = 5.0
+
+#: Number of messages pipelined in the batch RPC test
+BATCH_SIZE = 64
+
+#: If a test hangs for this long (seconds), tracebacks of all threads are
+#: dumped to stderr, so the stuck call can be found
+HANG_TIMEOUT = 30.0
 
 logging.config.dictConfig(cfg.logging)
 
-log = logging.getLogger()
+log = logging.getLogger('occo.test')
 
 def dummy(*args, **kwargs):
     pass
 
+#: Queue name suffix of this test run, so concurrent runs (including
+#: parallel test worker processes) do not interfere
+SUFFIX = '{0}_{1}'.format(os.environ.get('PYTEST_XDIST_WORKER', 'main'),
+                          uuid.uuid4().hex)
+
+def unique_endpoint(name, suffix=SUFFIX):
+    """
+    Copy of the endpoint configuration ``name`` with the queue names made
+    unique by ``suffix``, so test runs do not interfere with each other.
+    """
+    endpoint = dict(cfg.endpoints[name])
+    endpoint['routing_key'] = '{0}_{1}'.format(endpoint['routing_key'], suffix)
+    if 'queue' in endpoint:
+        endpoint['queue'] = '{0}_{1}'.format(endpoint['queue'], suffix)
+    return endpoint
+
 class MQBootstrapTest(unittest.TestCase):
-    def setUp(self):
-        self.test_config = cfg.default_mqconfig
-        self.fail_config_2 = dict(protocol='amqp', processor=None)
-    def test_inst(self):
-        list(map(lambda cls1_cls2: \
+    @classmethod
+    def setUpClass(cls):
+        cls.test_config = cfg.default_mqconfig
+        cls.fail_config_2 = dict(protocol='amqp', processor=None)
+    def test_instantiation(self):
+        for cls1, cls2, kwargs in [
+                (comm.AsynchronProducer, mq.MQAsynchronProducer, {}),
+                (comm.RPCProducer, mq.MQRPCProducer, {}),
+                (comm.EventDrivenConsumer, mq.MQEventDrivenConsumer,
+                 dict(processor=dummy))]:
+            with self.subTest(cls=cls1):
                 self.assertEqual(
-                    cls1_cls2[0].instantiate(**self.test_config).__class__,
-                    cls1_cls2[1]),
-            [(comm.AsynchronProducer, mq.MQAsynchronProducer),
-             (comm.RPCProducer, mq.MQRPCProducer)]))
-    def test_inst_consumer(self):
-        self.assertEqual(
-            comm.EventDrivenConsumer.instantiate(
-                processor=dummy, **self.test_config).__class__,
-            mq.MQEventDrivenConsumer)
+                    cls1.instantiate(**kwargs, **self.test_config).__class__,
+                    cls2)
     def test_bad_amqp(self):
-        def tst(cls):
-            with self.assertRaises(exc.ConfigurationError):
-                cls.instantiate(**self.fail_config_2)
-        list(map(tst, [comm.AsynchronProducer, comm.RPCProducer,
-                  comm.EventDrivenConsumer]))
+        for cls in [comm.AsynchronProducer, comm.RPCProducer,
+                    comm.EventDrivenConsumer]:
+            with self.subTest(cls=cls):
+                with self.assertRaises(exc.ConfigurationError):
+                    cls.instantiate(**self.fail_config_2)
+
+class _SharedConsumerThread(threading.Thread):
+    """
+    Long-lived consumer thread shared by the tests of this module.
+
+    Each test installs its own consumer core with :meth:`set_processor`;
+    the consumer itself is only cancelled by :meth:`stop`.
+    """
+    def __init__(self, endpoint):
+        # A daemon, so a consumer stuck in the broker cannot keep the test
+        # process alive after tearDownClass gave up on joining it
+        super(_SharedConsumerThread, self).__init__(daemon=True)
+        self.cancel_event = threading.Event()
+        self.ready = threading.Event()
+        self.core = dummy
+        self.consumer = comm.EventDrivenConsumer.instantiate(
+            processor=self.dispatch, cancel_event=self.cancel_event,
+            **endpoint)
+    def set_processor(self, core):
+        self.core = core
+    def dispatch(self, msg, *args, **kwargs):
+        return self.core(msg, *args, **kwargs)
+    def run(self):
+        with self.consumer:
+            self.ready.set()
+            self.consumer()
+    def stop(self):
+        """Cancels the consumer; returns whether the thread has exited."""
+        self.cancel_event.set()
+        self.join(TIMEOUT)
+        return not self.is_alive()
+
+#: Shared consumers, started in :meth:`MQConnectionTest.setUpClass`
+consumers = dict()
+
+def _stop_consumers():
+    stuck = [name for name, c in consumers.items() if not c.stop()]
+    consumers.clear()
+    return stuck
 
 class MQConnectionTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        log.info('PID: %s', os.getpid())
+        # Endpoint configurations are built once, not in every test
+        cls.endpoints = dict((name, unique_endpoint(name))
+                             for name in cfg.endpoints)
+        for name in ['consumer_rpc', 'consumer_async']:
+            consumers[name] = _SharedConsumerThread(cls.endpoints[name])
+            consumers[name].start()
+        try:
+            # The consumers declare the test queues once; the producers are
+            # configured to only check them passively (declare_passive)
+            failed = [name for name, c in consumers.items()
+                      if not c.ready.wait(TIMEOUT)]
+            if failed:
+                raise RuntimeError(
+                    'Shared consumers have not started: {0!r}'.format(failed))
+            # The producers (and their channels) are shared by the tests
+            cls._p = comm.RPCProducer.instantiate(
+                **cls.endpoints['producer_rpc'])
+            cls._p.__enter__()
+            try:
+                cls._async_p = comm.AsynchronProducer.instantiate(
+                    **cls.endpoints['producer_async'])
+                cls._async_p.__enter__()
+            except BaseException:
+                cls._p.__exit__(None, None, None)
+                raise
+        except BaseException:
+            # tearDownClass is not called if setUpClass fails
+            _stop_consumers()
+            mq.close_connection_pool()
+            raise
+    @classmethod
+    def tearDownClass(cls):
+        try:
+            try:
+                cls._async_p.__exit__(None, None, None)
+            finally:
+                cls._p.__exit__(None, None, None)
+        finally:
+            try:
+                stuck = _stop_consumers()
+            finally:
+                mq.close_connection_pool()
+        if stuck:
+            raise RuntimeError(
+                'Shared consumers have not exited: {0!r}'.format(stuck))
     def setUp(self):
-        self.data = None
+        faulthandler.dump_traceback_later(HANG_TIMEOUT)
+    def tearDown(self):
+        faulthandler.cancel_dump_traceback_later()
+        for c in consumers.values():
+            c.set_processor(dummy)
     def test_rpc_init_prod(self):
-        with comm.RPCProducer.instantiate(**cfg.endpoints['producer_rpc']):
+        with comm.RPCProducer.instantiate(**self.endpoints['producer_rpc']):
             log.debug('Test connection producer_rpc')
     def test_async_init_prod(self):
         with comm.AsynchronProducer.instantiate(
-                **cfg.endpoints['producer_async']):
+                **self.endpoints['producer_async']):
             log.debug('Test connection producer_async')
     def test_init_consumer(self):
         with comm.EventDrivenConsumer.instantiate(
-                processor=dummy, **cfg.endpoints['consumer_rpc']):
+                processor=dummy, **self.endpoints['consumer_rpc']):
             log.debug('Test connection consumer_rpc')
     def i_test_rpc(self):
         MSG = str(uuid.uuid4())
-        EXPECTED = 'RE: {0}'.format(MSG)
-        e = threading.Event()
+        EXPECTED = f'RE: {MSG}'
         def consumer_core(msg, *args, **kwargs):
             log.debug('RPC Consumer: message has arrived')
-            return comm.Response(200, 'RE: {0}'.format(msg))
-        p = comm.RPCProducer.instantiate(**cfg.endpoints['producer_rpc'])
-        c = comm.EventDrivenConsumer.instantiate(
-            processor=consumer_core, cancel_event=e,
-            **cfg.endpoints['consumer_rpc'])
-        with p, c:
-            log.debug('RPC Creating thread object')
-            t = threading.Thread(target=c)
-            log.debug('RPC Starting thread')
-            t.start()
-            log.debug('RPC thread started, sending RPC message and '
-                      'waiting for response')
-            try:
-                retval = p.push_message(MSG)
-                log.debug('Response arrived')
-                self.assertEqual(retval, EXPECTED)
-            finally:
-                log.debug('Setting cancel event')
-                e.set()
-                log.debug('Waiting for RPC Consumer to exit')
-                t.join()
-                log.debug('Consumer exited')
+            return comm.Response(200, f'RE: {msg}')
+        consumers['consumer_rpc'].set_processor(consumer_core)
+        log.debug('RPC sending RPC message and waiting for response')
+        retval = self._p.push_message(MSG)
+        log.debug('Response arrived')
+        self.assertEqual(retval, EXPECTED)
     def test_rpc(self):
         log.debug('Starting test RPC')
         self.i_test_rpc()
 
     def test_rpc_error(self):
         MSG = str(uuid.uuid4())
-        EXPECTED = 'RE: {0}'.format(MSG)
-        e = threading.Event()
         def consumer_core(msg, *args, **kwargs):
             log.debug('RPC Consumer: message has arrived')
-            return comm.Response(400, 'RE: {0}'.format(msg))
-        p = comm.RPCProducer.instantiate(**cfg.endpoints['producer_rpc'])
-        c = comm.EventDrivenConsumer.instantiate(
-            processor=consumer_core, cancel_event=e,
-            **cfg.endpoints['consumer_rpc'])
-        with p, c:
-            log.debug('RPC Creating thread object')
-            t = threading.Thread(target=c)
-            log.debug('RPC Starting thread')
-            t.start()
-            log.debug('RPC thread started, sending RPC message and '
-                      'waiting for response')
-            with self.assertRaises(exc.CriticalError):
-                try:
-                    retval = p.push_message(MSG)
-                finally:
-                    log.debug('Setting cancel event')
-                    e.set()
-                    log.debug('Waiting for RPC Consumer to exit')
-                    t.join()
-                    log.debug('Consumer exited')
+            return comm.Response(400, f'RE: {msg}')
+        consumers['consumer_rpc'].set_processor(consumer_core)
+        with self.assertRaises(exc.CriticalError):
+            self._p.push_message(MSG)
 
     def test_rpc_500_exception(self):
         MSG = str(uuid.uuid4())
-        EXPECTED = 'RE: {0}'.format(MSG)
-        e = threading.Event()
         def consumer_core(msg, *args, **kwargs):
             log.debug('RPC Consumer: message has arrived')
             raise ValueError('Test exception')
-        p = comm.RPCProducer.instantiate(**cfg.endpoints['producer_rpc'])
-        c = comm.EventDrivenConsumer.instantiate(
-            processor=consumer_core, cancel_event=e,
-            **cfg.endpoints['consumer_rpc'])
-        with p, c:
-            log.debug('RPC Creating thread object')
-            t = threading.Thread(target=c)
-            log.debug('RPC Starting thread')
-            t.start()
-            log.debug('RPC thread started, sending RPC message and '
-                      'waiting for response')
-            with self.assertRaises(exc.TransientError):
-                try:
-                    retval = p.push_message(MSG)
-                finally:
-                    log.debug('Setting cancel event')
-                    e.set()
-                    log.debug('Waiting for RPC Consumer to exit')
-                    t.join()
-                    log.debug('Consumer exited')
+        consumers['consumer_rpc'].set_processor(consumer_core)
+        with self.assertRaises(exc.TransientError):
+            self._p.push_message(MSG)
 
     def test_rpc_comm_exception(self):
         MSG = str(uuid.uuid4())
-        EXPECTED = 'RE: {0}'.format(MSG)
-        e = threading.Event()
         def consumer_core(msg, *args, **kwargs):
             log.debug('RPC Consumer: message has arrived')
             return comm.ExceptionResponse(403, ValueError())
-        p = comm.RPCProducer.instantiate(**cfg.endpoints['producer_rpc'])
-        c = comm.EventDrivenConsumer.instantiate(
-            processor=consumer_core, cancel_event=e,
-            **cfg.endpoints['consumer_rpc'])
-        with p, c:
-            log.debug('RPC Creating thread object')
-            t = threading.Thread(target=c)
-            log.debug('RPC Starting thread')
-            t.start()
-            log.debug('RPC thread started, sending RPC message and '
-                      'waiting for response')
-            with self.assertRaises(ValueError):
-                try:
-                    retval = p.push_message(MSG)
-                finally:
-                    log.debug('Setting cancel event')
-                    e.set()
-                    log.debug('Waiting for RPC Consumer to exit')
-                    t.join()
-                    log.debug('Consumer exited')
+        consumers['consumer_rpc'].set_processor(consumer_core)
+        with self.assertRaises(ValueError):
+            self._p.push_message(MSG)
 
     def i_test_rpc_double(self):
         salt = str(uuid.uuid4())
-        MSG, MSG2 = salt, 'hello-{0}'.format(salt)
-        EXPECTED, EXPECTED2 = 'RE: {0}'.format(MSG), 'RE: {0}'.format(MSG2)
-        e = threading.Event()
+        MSG, MSG2 = salt, f'hello-{salt}'
+        EXPECTED, EXPECTED2 = f'RE: {MSG}', f'RE: {MSG2}'
         def consumer_core(msg, *args, **kwargs):
             log.debug('Double RPC Consumer: message has arrived')
-            return comm.Response(200, 'RE: {0}'.format(msg))
-        p = comm.RPCProducer.instantiate(**cfg.endpoints['producer_rpc'])
-        c = comm.EventDrivenConsumer.instantiate(
-            processor=consumer_core, cancel_event=e,
-            **cfg.endpoints['consumer_rpc'])
-        with p, c:
-            log.debug('Double RPC Creating thread object')
-            t = threading.Thread(target=c)
-            log.debug('Double RPC Starting thread')
-            t.start()
-            log.debug('Double RPC thread started, sending RPC message and '
-                      'waiting for response')
-            try:
-                retval = p.push_message(MSG)
-                log.debug('Sending second RPC message and waiting for response')
-                retval2 = p.push_message(MSG2)
-                log.debug('Second response arrived')
-                self.assertEqual(retval, EXPECTED)
-                self.assertEqual(retval2, EXPECTED2)
-            finally:
-                log.debug('Setting cancel event')
-                e.set()
-                log.debug('Waiting for RPC Consumer to exit')
-                t.join()
-                log.debug('Consumer exited')
+            return comm.Response(200, f'RE: {msg}')
+        consumers['consumer_rpc'].set_processor(consumer_core)
+        log.debug('Double RPC sending RPC messages and waiting for responses')
+        retval, retval2 = self._p.push_messages([MSG, MSG2])
+        log.debug('Both responses arrived')
+        self.assertEqual(retval, EXPECTED)
+        self.assertEqual(retval2, EXPECTED2)
     def test_rpc_double(self):
         log.debug('Starting double test RPC')
         self.i_test_rpc_double()
 
+    def test_rpc_batch(self):
+        salt = str(uuid.uuid4())
+        MSGS = [f'{i}-{salt}' for i in range(BATCH_SIZE)]
+        def consumer_core(msg, *args, **kwargs):
+            return comm.Response(200, f'RE: {msg}')
+        consumers['consumer_rpc'].set_processor(consumer_core)
+        log.debug('Batch RPC sending %d messages', BATCH_SIZE)
+        retvals = self._p.push_messages(MSGS)
+        log.debug('Batch RPC responses arrived')
+        self.assertEqual(retvals, [f'RE: {msg}' for msg in MSGS])
+
     def test_async(self):
         MSG = 'test message abc'
         EXPECTED = 'RE: test message abc'
-        e = threading.Event()
-        r = threading.Event()
+        response = concurrent.futures.Future()
         def consumer_core(msg, *args, **kwargs):
             log.debug('Async Consumer: message has arrived')
-            self.data = 'RE: {0}'.format(msg)
-            log.debug('Async Consumer: setting response event')
-            r.set()
-            log.debug('Async consumer: response event has been set')
-        p = comm.AsynchronProducer.instantiate(
-            **cfg.endpoints['producer_async'])
-        c = comm.EventDrivenConsumer.instantiate(
-            processor=consumer_core, cancel_event=e,
-            **cfg.endpoints['consumer_async'])
-
-        with p, c:
-            log.debug('Async Creating thread object')
-            t = threading.Thread(target=c)
-            log.debug('Async Starting thread')
-            t.start()
-            log.debug('Async thread started, sending Async message')
-            p.push_message(MSG)
-            log.debug('Waiting Async arrival')
-            r.wait()
-            log.debug('Async message has arrived')
-            self.assertEqual(self.data, EXPECTED)
-            log.debug('Setting Async cancel event')
-            e.set()
-            log.debug('Waiting for Async Consumer to exit')
-            t.join()
-            log.debug('Consumer exited')
-
-def setup_module():
-    import os
-    log.info('PID: {0}'.format(os.getpid()))
+            response.set_result(f'RE: {msg}')
+            log.debug('Async consumer: response has been set')
+        consumers['consumer_async'].set_processor(consumer_core)
+        log.debug('Async sending Async message')
+        self._async_p.push_message(MSG)
+        log.debug('Waiting Async arrival')
+        self.assertEqual(response.result(TIMEOUT), EXPECTED)
+        log.debug('Async message has arrived')
@@ -0,0 +1,52 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+import unittest
+import multiprocessing
+import signal
+import time
+import occo.util.parproc as parproc
+
+TIMEOUT = 5
+
+def ignore_sigint(ready):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    ready.set()
+    while True:
+        time.sleep(1)
+
+class MixedSignalProcess(parproc.GracefulProcess):
+    # Signal names and numbers mixed
+    SIGLIST = ['SIGINT', 15, 'SIGKILL']
+
+class ParprocTest(unittest.TestCase):
+    def test_graceful_terminate(self):
+        ready = multiprocessing.Event()
+        p = MixedSignalProcess(target=ignore_sigint, args=(ready,))
+        p.start()
+        try:
+            self.assertTrue(ready.wait(TIMEOUT))
+            with self.assertLogs('occo.util.parproc', 'DEBUG') as cm:
+                p.graceful_terminate(1)
+            self.assertFalse(p.is_alive())
+            self.assertEqual(p.exitcode, -signal.SIGTERM)
+            output = '\n'.join(cm.output)
+            self.assertIn('SIGINT: Process {0} has not exited'.format(p.pid),
+                          output)
+            self.assertIn('Trying SIGTERM', output)
+            self.assertIn('killed with SIGTERM', output)
+        finally:
+            if p.is_alive():
+                p.kill()
+            p.join()
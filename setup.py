@@ -41,6 +41,7 @@ setuptools.setup(
         'pika',
         'python-dateutil',
         'pytz',
+        'PyYAML',
         'ruamel.yaml',
         'six',
         'requests',